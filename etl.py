@@ -1,91 +1,229 @@
 # Importing Libraries as Required
+import argparse
 import configparser
-from datetime import datetime
 import os
+from pyspark import StorageLevel, __version__ as spark_version
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, col
-from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format
+from pyspark.sql.functions import array, col, explode, expr, first, from_unixtime, lit, rand, to_date
+from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear
+from pyspark.sql.types import StructType, StructField, StringType, IntegerType, LongType, DoubleType
 
 # Setting Configurations to Access S3 buckets from my account. 
 # In the Configurtions file header was not present hence added the header as AWS
+# Credentials are handed to S3A through the Spark session in create_spark_session
 config = configparser.ConfigParser()
 config.read('dl.cfg')
-os.environ['AWS_ACCESS_KEY_ID']=config['AWS']['AWS_ACCESS_KEY_ID']
-os.environ['AWS_SECRET_ACCESS_KEY']=config['AWS']['AWS_SECRET_ACCESS_KEY']
 
-def create_spark_session():
+# Schemas of the Udacity song and log files
+# Passing them to the JSON reader skips the extra job Spark runs over all the files to infer the schema
+# Log schema only has the fields used by the users, time and songplays tables so the parser skips the rest
+SONG_SCHEMA = StructType([
+    StructField("song_id", StringType()),
+    StructField("title", StringType()),
+    StructField("artist_id", StringType()),
+    StructField("year", IntegerType()),
+    StructField("duration", DoubleType()),
+    StructField("artist_name", StringType()),
+    StructField("artist_location", StringType()),
+    StructField("artist_latitude", DoubleType()),
+    StructField("artist_longitude", DoubleType()),
+    StructField("num_songs", IntegerType())
+])
+
+LOG_SCHEMA = StructType([
+    StructField("ts", LongType()),
+    StructField("userId", StringType()),
+    StructField("firstName", StringType()),
+    StructField("lastName", StringType()),
+    StructField("gender", StringType()),
+    StructField("level", StringType()),
+    StructField("page", StringType()),
+    StructField("sessionId", IntegerType()),
+    StructField("location", StringType()),
+    StructField("userAgent", StringType()),
+    StructField("song", StringType())
+])
+
+def create_spark_session(shuffle_partitions=16):
     '''
     Function Defination - This function is to create the Spark Session and launch hadoop
-    Parameters - None
+        Hive support is enabled so the bucketed songs table is registered in the metastore
+        Adaptive Query Execution is enabled so small shuffle partitions are coalesced and skewed joins are split at runtime
+        Parquet files are committed to S3 through the S3A magic committer, which avoids the copy and delete of renaming on S3
+        The magic committer needs a Spark 3.4 or 3.5 build for Hadoop 3.3.4 and Scala 2.12, spark-hadoop-cloud is fetched for the running Spark version
+        AWS credentials from dl.cfg are passed to S3A directly, falling back to the default S3A credential chain when they are empty
+        S3 listings of the log data glob and Parquet partition discovery run on multiple threads
+        Shuffle partitions default to 16 for the song-data/A/A/A subset, AQE starts every shuffle from this number and coalesces down
+    Parameters - Number of shuffle partitions (optional, larger values are needed for full datasets)
     Return - It returns the spark connection to the calling function
     '''
-    spark = SparkSession \
+    builder = SparkSession \
         .builder \
-        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
-        .getOrCreate()
+        .enableHiveSupport() \
+        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:3.3.4,org.apache.spark:spark-hadoop-cloud_2.12:" + spark_version) \
+        .config("spark.sql.adaptive.enabled", "true") \
+        .config("spark.sql.adaptive.coalescePartitions.enabled", "true") \
+        .config("spark.sql.adaptive.skewJoin.enabled", "true") \
+        .config("spark.sql.shuffle.partitions", str(shuffle_partitions)) \
+        .config("spark.sql.adaptive.advisoryPartitionSizeInBytes", "128MB") \
+        .config("spark.sql.parquet.enableVectorizedReader", "true") \
+        .config("spark.sql.parquet.filterPushdown", "true") \
+        .config("spark.sql.parquet.compression.codec", "snappy") \
+        .config("spark.hadoop.parquet.block.size", "134217728") \
+        .config("spark.hadoop.parquet.enable.summary-metadata", "false") \
+        .config("spark.hadoop.fs.s3a.committer.name", "magic") \
+        .config("spark.hadoop.fs.s3a.committer.magic.enabled", "true") \
+        .config("spark.sql.sources.commitProtocolClass", "org.apache.spark.internal.io.cloud.PathOutputCommitProtocol") \
+        .config("spark.sql.parquet.output.committer.class", "org.apache.spark.internal.io.cloud.BindingParquetOutputCommitter") \
+        .config("spark.hadoop.fs.s3a.threads.max", "64") \
+        .config("spark.hadoop.fs.s3a.connection.maximum", "128") \
+        .config("spark.hadoop.mapreduce.input.fileinputformat.list-status.num-threads", "32") \
+        .config("spark.hadoop.fs.s3a.experimental.input.fadvise", "normal") \
+        .config("spark.sql.sources.parallelPartitionDiscovery.threshold", "1") \
+        .config("spark.hadoop.fs.s3a.fast.upload.buffer", "bytebuffer") \
+        .config("spark.hadoop.fs.s3a.multipart.size", "67108864")
+    
+    # Using the keys from dl.cfg when present, otherwise the default S3A credential chain (environment, profile, instance role)
+    if config['AWS']['AWS_ACCESS_KEY_ID'] and config['AWS']['AWS_SECRET_ACCESS_KEY']:
+        builder = builder \
+            .config("spark.hadoop.fs.s3a.access.key", config['AWS']['AWS_ACCESS_KEY_ID']) \
+            .config("spark.hadoop.fs.s3a.secret.key", config['AWS']['AWS_SECRET_ACCESS_KEY'])
+    
+    spark = builder.getOrCreate()
     return spark
 
+def path_exists(spark, path):
+    '''
+    Function Defination - This function checks through the Hadoop file system of the Spark Session whether a path exists in S3
+    Parameters - Spark Connection, path to check
+    Return - It returns True when the path exists otherwise False
+    '''
+    hadoop_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    return hadoop_path.getFileSystem(spark._jsc.hadoopConfiguration()).exists(hadoop_path)
+
+def replace_partitions(spark, staging_path, target_path):
+    '''
+    Function Defination - This function moves every partition folder written to a staging path in S3 into the target path, replacing the target partitions of the same name
+        Partitions of the target path that are not in the staging path are kept, and the staging path is deleted at the end
+    Parameters - Spark Connection, staging path the partitions were written to, target path the partitions are moved to
+    Return - None
+    '''
+    jvm_path = spark._jvm.org.apache.hadoop.fs.Path
+    staging = jvm_path(staging_path)
+    target = jvm_path(target_path)
+    fs = staging.getFileSystem(spark._jsc.hadoopConfiguration())
+    fs.mkdirs(target)
+    for status in fs.listStatus(staging):
+        name = status.getPath().getName()
+        if status.isDirectory() and "=" in name:
+            fs.delete(jvm_path(target, name), True)
+            fs.rename(status.getPath(), jvm_path(target, name))
+    fs.delete(staging, True)
+
 def process_song_data(spark, input_data, output_data):
     '''
     Function Defination - This function processes the song file retrived from Udacity S3 Bucket and stores the songs and artist    dimensional tables in my individual S3 Bucket
     Parameters - Spark Connection, S3 Bucket link for Udacity, S3 Bucket link for my AWS account respectively
-    Return - None
+    Return - It returns the songs table dataframe so it can be joined to the logs without reading it back from S3, 
+        and the persisted song data dataframe it is built from so the caller can unpersist it once the songs table is used
     '''
     # get filepath to song data file
     # Getting only the file from path "song-data/A/A/A/*.json" as processing full file is taking more than 3-4 hours
     song_data = os.path.join(input_data,"song-data/A/A/A/*.json")
     
     # read song data file
-    df = spark.read.json(song_data)
-    df.createOrReplaceTempView("songs")
+    df = spark.read.schema(SONG_SCHEMA).json(song_data)
+    
+    # Persisting song data so songs and artists tables are extracted from a single scan of the JSON files
+    df = df.persist(StorageLevel.MEMORY_AND_DISK)
     
     # Printing songs df Schema
     print('SONGS Dataframe Schema')
     df.printSchema()
 
     # extract columns to create songs table
-    songs_table = spark.sql('''
-                            SELECT distinct song_id, 
-                                            title, 
-                                            artist_id, 
-                                            year, 
-                                            duration 
-                            FROM   songs
-                            WHERE  song_id IS NOT NULL
-                            ''')
+    # dropDuplicates on the key lets Spark de-duplicate partially on each partition before the shuffle
+    songs_table = df.select("song_id", "title", "artist_id", "year", "duration") \
+                    .filter("song_id IS NOT NULL") \
+                    .dropDuplicates(["song_id"])
     
     # write songs table to parquet files partitioned by year and artist
-    songs_table.write.partitionBy("year", "artist_id").parquet(path = output_data + "/songs/songs.parquet", mode = "overwrite")
+    # bucketing by title lets later joins on the song title read the songs table without shuffling it
+    # repartitioning by the partition columns sends each output partition to one task so it is not split into many small files
+    songs_table.repartition("year", "artist_id").write.bucketBy(16, "title").sortBy("title").partitionBy("year", "artist_id") \
+               .saveAsTable("songs", format = "parquet", path = output_data + "/songs/songs.parquet", mode = "overwrite")
     
     print('Song Table Uploaded')
 
     # extract columns to create artists table
-    artists_table = spark.sql('''
-                              SELECT distinct artist_id, 
-                                              artist_name, 
-                                              artist_location, 
-                                              artist_latitude, 
-                                              artist_longitude 
-                              FROM   songs
-                              WHERE  artist_id IS NOT NULL
-                              ''')
+    artists_table = df.select("artist_id", "artist_name", "artist_location", "artist_latitude", "artist_longitude") \
+                      .filter("artist_id IS NOT NULL") \
+                      .dropDuplicates(["artist_id"])
     
     # write artists table to parquet files
     artists_table.write.parquet(path = output_data + "/artists/artists.parquet", mode = "overwrite")
     
     print('Artists Table Uploaded')
     
-def process_log_data(spark, input_data, output_data):
+    return songs_table, df
+    
+def convert_logs_to_parquet(spark, input_data, output_data, log_year=None, log_month=None):
     '''
-    Function Defination - This function processes the log file retrived from Udacity S3 Bucket and stores the user and time dimensional tables in my individual S3 Bucket
-    Parameters - Spark Connection, S3 Bucket link for Udacity, S3 Bucket link for my AWS account respectively
+    Function Defination - This function converts the JSON log files retrived from Udacity S3 Bucket into Parquet files partitioned by date in my individual S3 Bucket
+        Log data is append only hence it is parsed from JSON once and read as columnar Parquet afterwards, main only calls it on request or when the Parquet logs are missing
+        When a year is given only the date partitions present in the converted files are replaced, so a single month can be converted on its own
+        They are written to a staging path first, so a failed write leaves the raw logs untouched. A failure while swapping the partitions in can still 
+        leave some of those dates missing from the raw logs (S3 has no atomic rename), in that case run the same --year and --month again
+    Parameters - Spark Connection, S3 Bucket link for Udacity, S3 Bucket link for my AWS account respectively, 
+        year and month of the log files to convert (optional, all log files are converted when not given, month needs year)
     Return - None
     '''
+    if log_month and not log_year:
+        raise ValueError("log_month needs log_year, got log_month {}".format(log_month))
+    
     # get filepath to log data file
-    log_data = input_data + "log_data/*/*/*.json"
+    # log files are stored as log_data/YYYY/MM/YYYY-MM-DD-events.json hence only the prefix of the given year and month is listed
+    if log_year and log_month:
+        log_data = f"{input_data}log_data/{log_year}/{log_month:02d}/*.json"
+    elif log_year:
+        log_data = f"{input_data}log_data/{log_year}/*/*.json"
+    else:
+        log_data = input_data + "log_data/*/*/*.json"
 
     # read log data file
-    df = spark.read.json(log_data)
+    # events without ts have no date partition hence they are dropped
+    df = spark.read.schema(LOG_SCHEMA).json(log_data).filter("ts IS NOT NULL")
+    
+    # create date column from original timestamp column to partition the raw logs
+    df = df.withColumn("date", to_date(from_unixtime(col('ts') / 1000)))
+    
+    raw_logs_path = output_data + "/raw_logs/raw_logs.parquet"
+    
+    if log_year:
+        # the magic committer does not support dynamic partition overwrite
+        # hence the converted files are written to a staging path first and only their date partitions are swapped into the raw logs, other dates are kept
+        staging_path = output_data + "/raw_logs_staging"
+        df.write.partitionBy("date").parquet(path = staging_path, mode = "overwrite")
+        replace_partitions(spark, staging_path, raw_logs_path)
+    else:
+        # write raw logs to parquet files partitioned by date
+        df.write.partitionBy("date").parquet(path = raw_logs_path, mode = "overwrite")
+    
+    print('Raw Logs Converted to Parquet')
+    
+def process_log_data(spark, output_data, songs_df=None, salt_buckets=0):
+    '''
+    Function Defination - This function processes the log file converted to Parquet in my S3 Bucket and stores the user and time dimensional tables in my individual S3 Bucket
+    Parameters - Spark Connection, S3 Bucket link for my AWS account, 
+        songs table dataframe returned by process_song_data (optional, when not given the bucketed songs table is read if it is in the metastore, otherwise the songs Parquet in my S3 Bucket), 
+        number of salt buckets for the songplays join (optional, only for full datasets where songs cannot be broadcast and AQE skew join is not enough)
+    Return - None
+    '''
+    if salt_buckets < 0:
+        raise ValueError("salt_buckets must be 0 or more, got {}".format(salt_buckets))
+    
+    # read log data converted to parquet by convert_logs_to_parquet
+    df = spark.read.parquet(output_data + "/raw_logs/raw_logs.parquet")
 
     # Creating Temporary table
     df.createOrReplaceTempView("staging_events")
@@ -99,13 +237,17 @@ def process_log_data(spark, input_data, output_data):
     
     print('Staging events Table Filtered')
     
-    # create timestamp column from original timestamp column
-    get_timestamp = udf(lambda x: str(int(int(x)/1000)))
-    df = df.withColumn('timestamp', get_timestamp(df.ts))
+    # create timestamp column from original timestamp column (epoch milliseconds)
+    # Native Spark expressions are used instead of Python UDFs so the rows never leave the JVM
+    # ts_ts is typed as timestamp once here and every time part below is derived from it
+    df = df.withColumn('ts_ts', (col('ts') / 1000).cast('timestamp'))
+    
+    # create year and month columns once so songplays table partitions are not recomputed in the join
+    df = df.withColumn("year", year(col("ts_ts"))).withColumn("month", month(col("ts_ts")))
     
-    # create datetime column from original timestamp column
-    get_datetime = udf(lambda x: str(datetime.fromtimestamp(int(x) / 1000.0)))
-    df = df.withColumn("datetime", get_datetime(df.ts))
+    # Persisting filtered events as they are scanned by users, time and songplays tables
+    # MEMORY_AND_DISK is PySpark's serialized memory and disk level, unlike the MEMORY_AND_DISK_DESER default of persist
+    df = df.persist(StorageLevel.MEMORY_AND_DISK)
     
     # Creating Temporary table after filtering for song plays
     df.createOrReplaceTempView("staging_events")
@@ -115,14 +257,12 @@ def process_log_data(spark, input_data, output_data):
     df.printSchema()
     
     # extract columns for users table    
-    users_table = spark.sql('''
-                            SELECT  DISTINCT userId,
-                                    firstName,
-                                    lastName,
-                                    gender
-                            FROM    staging_events
-                            WHERE   userId IS NOT NULL
-                            ''')
+    # grouping by userId aggregates each user to one row per partition before the shuffle, so heavy users do not skew it
+    users_table = df.filter("userId IS NOT NULL") \
+                    .groupBy("userId") \
+                    .agg(first("firstName").alias("firstName"), 
+                         first("lastName").alias("lastName"), 
+                         first("gender").alias("gender"))
     
     # write users table to parquet files
     users_table.write.parquet(path = output_data + "/users/users.parquet", mode = "overwrite")
@@ -130,35 +270,64 @@ def process_log_data(spark, input_data, output_data):
     print('User Table Uploaded')
     
     # extract columns to create time table
-    time_table = spark.sql('''
-                           SELECT distinct timestamp as start_time, 
-                                  hour(timestamp) as hour, 
-                                  day(timestamp) as day, 
-                                  weekofyear(timestamp) as week, 
-                                  month(timestamp) as month, 
-                                  year(timestamp) as year, 
-                                  weekday(timestamp) as weekday
-                           FROM   staging_events
-                           ''')
-    
-    # write time table to parquet files partitioned by year and month
-    time_table.write.partitionBy("year", "month").parquet(path = output_data + "/time/time.parquet", mode = "overwrite")
+    # timestamps are de-duplicated first so the shuffle carries only the driving key and not the 6 derived columns
+    time_table = df.select(col("ts_ts").alias("start_time")) \
+                   .dropDuplicates(["start_time"]) \
+                   .select("start_time", 
+                           hour("start_time").alias("hour"), 
+                           dayofmonth("start_time").alias("day"), 
+                           weekofyear("start_time").alias("week"), 
+                           month("start_time").alias("month"), 
+                           year("start_time").alias("year"), 
+                           expr("weekday(start_time)").alias("weekday"))
+    
+    # write time table to parquet files partitioned by year and month, one file per partition
+    time_table.repartition("year", "month").write.partitionBy("year", "month").parquet(path = output_data + "/time/time.parquet", mode = "overwrite")
     
     print('Time Table Uploaded')
 
     # read in song data to use for songplays table
-    song_df = spark.read.parquet(output_data + "/songs/songs.parquet")
+    # songs table from process_song_data is reused when given, saving a round trip through my S3 Bucket
+    bucketed_songs = False
+    if songs_df is not None:
+        song_df = songs_df
+    elif spark.catalog.tableExists("songs"):
+        # bucketed songs table registered by an earlier run in this metastore, read with its bucketing
+        song_df = spark.table("songs")
+        bucketed_songs = True
+        print('Songs Parquet Downloaded from my S3')
+    else:
+        song_df = spark.read.parquet(output_data + "/songs/songs.parquet")
+        print('Songs Parquet Downloaded from my S3')
     song_df.createOrReplaceTempView("songs_parquet")
     
-    print('Songs Parquet Downloaded from my S3')
-    
     # Printing songs_parquet df Schema from my S3 Bucket
     print('SONGS_PARQUET Dataframe Schema')
     song_df.printSchema()
 
+    if salt_buckets:
+        # popular song titles are spread over salt_buckets reducers by salting the join key
+        # every song is replicated once per salt value and every event gets a random salt value
+        song_df.withColumn("salt", explode(array([lit(i) for i in range(salt_buckets)]))) \
+               .createOrReplaceTempView("songs_parquet")
+        df.withColumn("salt", (rand() * salt_buckets).cast("int")) \
+          .createOrReplaceTempView("staging_events")
+        join_hint = ""
+        join_condition = "a.song = b.title and a.salt = b.salt"
+    elif bucketed_songs:
+        # songs table is already bucketed by title hence a sort merge join only shuffles the log events
+        # MERGE hint keeps Spark from broadcasting songs instead, which would ignore the buckets
+        join_hint = "/*+ MERGE(b) */"
+        join_condition = "a.song = b.title"
+    else:
+        # songs table is small hence it is broadcast to every executor to avoid shuffling the log events
+        join_hint = "/*+ BROADCAST(b) */"
+        join_condition = "a.song = b.title"
+
     # extract columns from joined song and log datasets to create songplays table 
-    songplays_table = spark.sql('''
-                                SELECT a.timestamp as start_time, 
+    songplays_table = spark.sql(f'''
+                                SELECT {join_hint}
+                                       a.ts_ts as start_time, 
                                        a.userId, 
                                        a.level, 
                                        b.song_id, 
@@ -166,32 +335,66 @@ def process_log_data(spark, input_data, output_data):
                                        a.sessionId, 
                                        a.location, 
                                        a.userAgent, 
-                                       year(a.timestamp) as year, 
-                                       month(a.timestamp) as month 
+                                       a.year, 
+                                       a.month 
                                 FROM staging_events as a 
-                                inner join songs_parquet as b on a.song = b.title
+                                inner join songs_parquet as b on {join_condition}
                                 ''')
 
-    # write songplays table to parquet files partitioned by year and month
+    # write songplays table to parquet files partitioned by year and month, one file per partition
+    songplays_table = songplays_table.repartition("year", "month")
     songplays_table.write.partitionBy("year", "month").parquet(path = output_data + "/songplays/songplays.parquet", mode = "overwrite")
     print('Fact Table is Uploaded')
     
+    # Releasing the cached staging events
+    df.unpersist()
+    
     
 def main():
     '''
     Function Defination - This is the main function and is used to call multiple functions below -
-        1. create_spark_session() - for creating spark session
+        1. create_spark_session(shuffle_partitions) - for creating spark session
         2. process_song_data(spark, input_data, output_data) - To Process song file from Udacity S3 Bucket 
-        3. process_log_data(spark, input_data, output_data) - To Process log file from Udacity S3 Bucket 
-    Parameters - None
+        3. convert_logs_to_parquet(spark, input_data, output_data, log_year, log_month) - To Convert log file from Udacity S3 Bucket to Parquet in my S3 Bucket, 
+           only with --convert-logs, --year or when the Parquet logs are not yet in my S3 Bucket (then all log files are converted)
+        4. process_log_data(spark, output_data, songs_df, salt_buckets) - To Process log file converted to Parquet in my S3 Bucket
+    Parameters - None (optional --shuffle-partitions N command line argument sets the shuffle partitions, 
+        optional --convert-logs command line argument converts the log files again, 
+        optional --year YYYY and --month MM command line arguments restrict the log files converted to Parquet, 
+        optional --salt-buckets N command line argument salts the songplays join instead of broadcasting songs)
     Return - None
     '''
-    spark = create_spark_session()
+    parser = argparse.ArgumentParser(description = "Sparkify data lake ETL")
+    parser.add_argument("--shuffle-partitions", type = int, default = 16, help = "number of shuffle partitions, 16 suits the song-data/A/A/A subset")
+    parser.add_argument("--convert-logs", action = "store_true", help = "convert the JSON log files to Parquet even when they were converted before")
+    parser.add_argument("--year", type = int, help = "year of the log files to convert, all years when not given")
+    parser.add_argument("--month", type = int, choices = range(1, 13), help = "month of the log files to convert, all months when not given, needs --year")
+    parser.add_argument("--salt-buckets", type = int, default = 0, help = "salt the songplays join over N buckets instead of broadcasting songs, only for full datasets")
+    args = parser.parse_args()
+    if args.month and not args.year:
+        parser.error("--month needs --year")
+    if args.salt_buckets < 0:
+        parser.error("--salt-buckets must be 0 or more")
+    
+    spark = create_spark_session(shuffle_partitions = args.shuffle_partitions)
     input_data = "s3a://udacity-dend/"
     output_data = "s3a://rahul-data-lake"
     
-    process_song_data(spark, input_data, output_data)    
-    process_log_data(spark, input_data, output_data)
+    songs_table, song_df = process_song_data(spark, input_data, output_data)    
+    
+    # Log files are converted to Parquet once, later runs read the Parquet logs already in my S3 Bucket
+    # When the Parquet logs are missing the full history is converted, as later runs would not convert the other months
+    if not path_exists(spark, output_data + "/raw_logs/raw_logs.parquet"):
+        if args.year:
+            print('Parquet Logs not found in my S3, converting all log files instead of the given year and month')
+        convert_logs_to_parquet(spark, input_data, output_data)
+    elif args.convert_logs or args.year:
+        convert_logs_to_parquet(spark, input_data, output_data, log_year = args.year, log_month = args.month)
+    
+    process_log_data(spark, output_data, songs_df = songs_table, salt_buckets = args.salt_buckets)
+    
+    # Releasing the cached song data once the songplays table is built from songs table
+    song_df.unpersist()
 
 
 if __name__ == "__main__":